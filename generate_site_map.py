@@ -1,82 +1,262 @@
-from aiohttp import ClientSession, client_exceptions
+from aiohttp import (
+    ClientSession,
+    ClientTimeout,
+    TCPConnector,
+    client_exceptions,
+)
+from aiohttp.connector import NEEDS_CLEANUP_CLOSED
 import asyncio
-import json
+from collections import defaultdict
+from contextlib import asynccontextmanager, suppress
+from functools import lru_cache
+import orjson
+import os
 import re
-from typing import Dict, List, Set, Union
+import time
+from typing import (
+    AsyncIterator,
+    DefaultDict,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+from yarl import URL
 
+try:
+    import re2
+except ImportError:
+    re2 = None
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
+
+SiteMap = Dict[str, Union[str, List[str]]]
 HREF_RE = (
     r"href=\""
-    r"(?P<url>https?\:\/\/(www\.)?(\S+\.)+[a-z]{2,}(\/[^\s\'\"]+)*\/?)\""
+    r"(?P<url>https?://(?:www\.)?[^\s\'\"/]+\.[a-zA-Z]{2,}(?::\d+)?"
+    r"(?:/[^\s\'\"]*)?)\""
 )
-HREF_PROG = re.compile(HREF_RE)
-IMAGE_EXTS = [".ico", ".png", ".jpg", ".gif"]
+# RE2 matches in linear time whatever the input, so it is used when the
+# optional google-re2 package is installed.
+HREF_PROG = re2.compile(HREF_RE) if re2 else re.compile(HREF_RE, re.ASCII)
+IMAGE_EXTS = (".ico", ".png", ".jpg", ".gif")
+MAX_CONNECTIONS = 100
+MAX_CONNECTIONS_PER_HOST = 4
+DNS_CACHE_TTL = 300
+TIMEOUT = ClientTimeout(total=15, connect=5)
+FETCH_ATTEMPTS = 3
+MAX_RESPONSE_BYTES = 2 * 1024 * 1024
+RETRY_BACKOFF = 0.3
+HEADERS = {"User-Agent": "SiteMapGenerator/1.0"}
+# Each worker has at most one request in flight, so this also bounds the
+# number of concurrent requests of a crawl.
+NUM_CRAWL_WORKERS = 50
+# The same navigation links appear on most pages of a site, so the results
+# of the per-link helpers below are cached.
+LINK_CACHE_SIZE = 65536
+MIN_FETCH_INTERVAL = 0.2
+SITE_MAP_PATH = "site_map.json"
+SITE_MAP_TEMP_PATH = SITE_MAP_PATH + ".tmp"
+
+
+class FetchLimiter:
+    """
+    Limit the requests sent to each host during one crawl.  At most
+    `MAX_CONNECTIONS_PER_HOST` requests are sent to the same host at a time,
+    and requests to the same host start at least `MIN_FETCH_INTERVAL` seconds
+    apart.  The total number of requests in flight is bounded by the crawl's
+    `NUM_CRAWL_WORKERS` workers.
+
+    A limiter must only be used within one event loop, since its semaphores
+    are bound to the loop that first waits on them.
+    """
+
+    def __init__(self) -> None:
+        self.host_semaphores: DefaultDict[str, asyncio.Semaphore] = (
+            defaultdict(lambda: asyncio.Semaphore(MAX_CONNECTIONS_PER_HOST))
+        )
+        self.last_fetch_times: Dict[str, float] = {}
+
+    @asynccontextmanager
+    async def slot(self, host: str) -> AsyncIterator[None]:
+        """Wait until a request may be sent to `host`."""
+        async with self.host_semaphores[host]:
+            now = time.monotonic()
+            start = max(
+                now,
+                self.last_fetch_times.get(host, 0.0) + MIN_FETCH_INTERVAL,
+            )
+            self.last_fetch_times[host] = start
+            await asyncio.sleep(start - now)
+            yield
+
+
+def decode_body(body: bytes, charset: Optional[str]) -> str:
+    """
+    Decode `body` with `charset`, falling back to UTF-8 if no charset is
+    given or it is unknown.  Undecodable bytes, such as a character cut off
+    by `MAX_RESPONSE_BYTES`, are replaced.
+    """
+    try:
+        return body.decode(charset or "utf-8", errors="replace")
+    except LookupError:
+        return body.decode("utf-8", errors="replace")
 
 
-async def fetch_html(session: ClientSession, url: str) -> str:
-    """Get the HTML string of `url`."""
-    async with session.get(url) as response:
-        return await response.text()
+async def fetch_html_once(
+    session: ClientSession,
+    url: str,
+    limiter: FetchLimiter,
+) -> str:
+    """
+    Get the HTML string of `url` with a single request, sent as soon as
+    `limiter` allows.  An empty string is returned without reading the body
+    if the response is declared to be something other than HTML.  Only the
+    first `MAX_RESPONSE_BYTES` bytes of the body are read.  A
+    `ClientResponseError` is raised for server errors.
+    """
+    async with limiter.slot(URL(url).host or ""):
+        async with session.get(url) as response:
+            if response.status >= 500:
+                response.raise_for_status()
+            content_type = response.headers.get("Content-Type", "text/html")
+            if "html" not in content_type.lower():
+                return ""
+            try:
+                body = await response.content.readexactly(MAX_RESPONSE_BYTES)
+            except asyncio.IncompleteReadError as error:
+                body = error.partial
+            return decode_body(body, response.charset)
+
+
+async def fetch_html(
+    session: ClientSession,
+    url: str,
+    limiter: FetchLimiter,
+) -> str:
+    """
+    Get the HTML string of `url` with `fetch_html_once()`.  Timeouts,
+    connection errors, and server errors are retried with exponential
+    backoff, and the error of the last of the `FETCH_ATTEMPTS` attempts is
+    raised.
+    """
+    for attempt in range(FETCH_ATTEMPTS - 1):
+        try:
+            return await fetch_html_once(session, url, limiter)
+        except (
+            asyncio.TimeoutError,
+            client_exceptions.ClientConnectionError,
+            client_exceptions.ClientPayloadError,
+            client_exceptions.ClientResponseError,
+        ):
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+    return await fetch_html_once(session, url, limiter)
 
 
 def get_all_links_from_html(html: str) -> List[str]:
     """Get a list of all unique links in `html`."""
-    href_matches = HREF_PROG.findall(html)
-    links = set([href_match[0] for href_match in href_matches])
-    return list(links)
+    return list(set(HREF_PROG.findall(html)))
 
 
+@lru_cache(maxsize=LINK_CACHE_SIZE)
 def strip_http_www(link: str) -> str:
-    """Strip leading "http" and "www" from `link`."""
-    if link.startswith("https://"):
-        link = link.lstrip("https://")
-    elif link.startswith("http://"):
-        link = link.lstrip("http://")
-    if link.startswith("www."):
-        link = link.lstrip("www.")
-    return link
+    """Strip trailing "/"s and leading "http" and "www" from `link`."""
+    link = link.strip("/")
+    link = link.removeprefix("https://").removeprefix("http://")
+    return link.removeprefix("www.")
 
 
-def get_domain_links(links: List[str], domain_url: str) -> List[str]:
+@lru_cache(maxsize=LINK_CACHE_SIZE)
+def canonicalize_url(url: str) -> str:
     """
-    Get the subset of links from `links` that begin with `domain_url` and are
-    not images.
+    Get the key used to decide whether two URLs are the same page.  The
+    scheme, a leading "www.", a default port, the fragment, and trailing "/"s
+    are dropped, the host is lowercased, and the query parameters are sorted.
     """
-    stripped_domain = strip_http_www(domain_url).strip("/")
-    return [
-        link for link in links
-        if strip_http_www(link).startswith(stripped_domain) and
-        not is_image_link(link)
-    ]
+    parsed = URL(url)
+    key = (parsed.host or "").lower().removeprefix("www.")
+    if not parsed.is_default_port():
+        key += f":{parsed.port}"
+    key += parsed.raw_path.rstrip("/")
+    if parsed.raw_query_string:
+        key += "?" + "&".join(sorted(parsed.raw_query_string.split("&")))
+    return key
 
 
+@lru_cache(maxsize=LINK_CACHE_SIZE)
 def is_image_link(link: str) -> bool:
     """Return `True` if `link` is a link to an image."""
-    return link[-4:].lower() in IMAGE_EXTS
+    return link.lower().endswith(IMAGE_EXTS)
+
+
+def partition_links(
+    links: List[str],
+    domain_url: Optional[str],
+) -> Tuple[List[str], List[str], List[str]]:
+    """
+    Split `links` in a single pass into the domain links, image links, and
+    non-image links, in that order.  Domain links are the non-image links
+    that begin with `domain_url`.  No domain links are collected if
+    `domain_url` is `None`.
+    """
+    stripped_domain = None
+    if domain_url is not None:
+        stripped_domain = strip_http_www(domain_url)
+    domain_links, image_links, non_image_links = [], [], []
+    for link in links:
+        if is_image_link(link):
+            image_links.append(link)
+            continue
+        non_image_links.append(link)
+        if (
+            stripped_domain is not None and
+            strip_http_www(link).startswith(stripped_domain)
+        ):
+            domain_links.append(link)
+    return domain_links, image_links, non_image_links
+
+
+def get_domain_links(links: List[str], domain_url: str) -> List[str]:
+    """
+    Get the subset of links from `links` that begin with `domain_url` and are
+    not images.
+    """
+    return partition_links(links, domain_url)[0]
 
 
 def get_image_links(links: List[str]) -> List[str]:
     """Get the subset of links from `links` that are links to images."""
-    return [link for link in links if is_image_link(link)]
+    return partition_links(links, None)[1]
 
 
 def get_non_image_links(links: List[str]) -> List[str]:
     """Get the subset of links from `links` that are not links to images."""
-    return [link for link in links if not is_image_link(link)]
+    return partition_links(links, None)[2]
 
 
-async def build_site_map(
+async def iter_site_maps(
     starting_url: str,
+    session: ClientSession,
     max_depth: int = 10,
-    processed_sites: Set[str] = set(),
-) -> List[Dict[str, Union[str, List[str]]]]:
+    processed_sites: Optional[Set[str]] = None,
+) -> AsyncIterator[SiteMap]:
     """
-    Build a list of site maps beginning from `starting_url` and ending at a
-    depth specified by `max_depth`.  Only domain URL site maps are generated.
+    Yield site maps beginning from `starting_url` and ending at a depth
+    specified by `max_depth`, as soon as each page has been crawled.  Only
+    domain URL site maps are generated.
     Site maps contain information about the page's URL, the page's links, and
     the page's images.
 
-    Here is an example site map:
+    Pages are crawled breadth-first: a pool of `NUM_CRAWL_WORKERS` workers
+    takes URLs from a frontier queue, and a page's domain links are added to
+    the frontier only if they have not been seen before.
+
+    Here is an example of the yielded site maps:
     [
         {
             "page_url": " https://www.mozilla.org/en-US/ ",
@@ -100,54 +280,148 @@ async def build_site_map(
     Arguments:
     starting_url:
         The current domain URL to build the site map from.
+    session:
+        The HTTP session shared by every request of the crawl, so that
+        connections to the same host are reused.
     max_depth:
         The deepest depth of the site map.
     processed_sites:
-        URLs whose site maps have already been generated.  Storing these sites
-        helps to ensure that duplicate site maps do not get generated.
+        Canonical forms (see `canonicalize_url()`) of the URLs that have
+        already been added to the frontier.  Storing these sites helps to
+        ensure that duplicate site maps do not get generated.
+        A new set is created for each crawl if this is not given.
 
-    Return:
-        A list of all domain URL site maps.
+    Yield:
+        Each domain URL site map.
     """
     if not max_depth:
-        return []
-    async with ClientSession() as session:
+        return
+    if processed_sites is None:
+        processed_sites = set()
+    try:
+        processed_sites.add(canonicalize_url(starting_url))
+    except ValueError:
+        print(f"Cannot process URL: \"{starting_url}\"")
+        return
+    limiter = FetchLimiter()
+    frontier: "asyncio.Queue[Tuple[str, int]]" = asyncio.Queue()
+    frontier.put_nowait((starting_url, max_depth))
+    # Crawled site maps, then `None` once the frontier is drained.  Errors
+    # raised while crawling a page are passed along to be re-raised here.
+    results: "asyncio.Queue[Union[SiteMap, Exception, None]]" = (
+        asyncio.Queue()
+    )
+
+    async def crawl() -> None:
+        while True:
+            url, depth = await frontier.get()
+            try:
+                await crawl_page(url, depth)
+            except Exception as error:
+                results.put_nowait(error)
+            finally:
+                frontier.task_done()
+
+    async def crawl_page(url: str, depth: int) -> None:
         try:
-            html = await fetch_html(session, starting_url)
-        except client_exceptions.ClientConnectionError:
-            print(f"Cannot process URL: \"{starting_url}\"")
-            return []
-    links = get_all_links_from_html(html)
-    domain_links = get_domain_links(links, starting_url)
-    image_links = get_image_links(links)
-    non_image_links = get_non_image_links(links)
-    site_map = [{
-        "page_url": starting_url,
-        "links": non_image_links,
-        "images": image_links
-    }]
-    processed_sites.add(starting_url.strip("/"))
-    if not domain_links:
-        return site_map
-    domain_link_coros = [
-        build_site_map(domain_link, max_depth - 1, processed_sites)
-        for domain_link in domain_links
-        if domain_link.strip("/") not in processed_sites
+            html = await fetch_html(session, url, limiter)
+        except (
+            asyncio.TimeoutError,
+            client_exceptions.ClientError,
+            ValueError,
+        ):
+            print(f"Cannot process URL: \"{url}\"")
+            return
+        # The children of pages at the last depth are never crawled, so their
+        # domain links are not needed.
+        is_last_depth = depth - 1 <= 0
+        domain_links, image_links, non_image_links = partition_links(
+            get_all_links_from_html(html), None if is_last_depth else url
+        )
+        results.put_nowait({
+            "page_url": url,
+            "links": non_image_links,
+            "images": image_links,
+        })
+        for domain_link in domain_links:
+            try:
+                key = canonicalize_url(domain_link)
+            except ValueError:
+                print(f"Cannot process URL: \"{domain_link}\"")
+                continue
+            if key not in processed_sites:
+                processed_sites.add(key)
+                frontier.put_nowait((domain_link, depth - 1))
+
+    async def finish() -> None:
+        await frontier.join()
+        results.put_nowait(None)
+
+    tasks = [asyncio.create_task(crawl()) for _ in range(NUM_CRAWL_WORKERS)]
+    tasks.append(asyncio.create_task(finish()))
+    try:
+        while (result := await results.get()) is not None:
+            if isinstance(result, Exception):
+                raise result
+            yield result
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def build_site_map(
+    starting_url: str,
+    session: ClientSession,
+    max_depth: int = 10,
+    processed_sites: Optional[Set[str]] = None,
+) -> List[SiteMap]:
+    """
+    Build a list of all site maps yielded by `iter_site_maps()`.  The
+    arguments are the same as those of `iter_site_maps()`.
+    """
+    return [
+        site_map async for site_map in iter_site_maps(
+            starting_url, session, max_depth, processed_sites
+        )
     ]
-    for out in await asyncio.gather(*domain_link_coros):
-        if out:
-            site_map.extend(out)
-    return site_map
 
 
 async def write_site_map(domain: str, max_depth: int) -> None:
-    """Write the generated site map into site_map.json."""
-    top_level_site_map = await build_site_map(domain, max_depth)
-    page_urls = [site_map["page_url"] for site_map in top_level_site_map]
-    if len(page_urls) != len(set(page_urls)):
-        print("The generated output contains some duplicate site maps.")
-    with open("site_map.json", "w") as f:
-        json.dump(top_level_site_map, f, indent=4)
+    """
+    Write the generated site map into site_map.json.  Each site map is
+    written on its own line as soon as its page has been crawled, so the
+    whole site map is never held in memory.  The site maps are written to a
+    temporary file that only replaces site_map.json once the crawl has
+    succeeded.
+    """
+    connector = TCPConnector(
+        limit=MAX_CONNECTIONS,
+        limit_per_host=MAX_CONNECTIONS_PER_HOST,
+        ttl_dns_cache=DNS_CACHE_TTL,
+        # Newer Pythons close aborted SSL transports themselves, and aiohttp
+        # warns if asked to do it too.
+        enable_cleanup_closed=NEEDS_CLEANUP_CLOSED,
+    )
+    async with ClientSession(
+        connector=connector,
+        timeout=TIMEOUT,
+        headers=HEADERS,
+    ) as session:
+        try:
+            with open(SITE_MAP_TEMP_PATH, "wb") as f:
+                f.write(b"[")
+                separator = b"\n"
+                async for site_map in iter_site_maps(
+                    domain, session, max_depth
+                ):
+                    f.write(separator + orjson.dumps(site_map))
+                    separator = b",\n"
+                f.write(b"\n]\n")
+            os.replace(SITE_MAP_TEMP_PATH, SITE_MAP_PATH)
+        finally:
+            with suppress(FileNotFoundError):
+                os.remove(SITE_MAP_TEMP_PATH)
 
 
 if __name__ == "__main__":
@@ -172,5 +446,7 @@ if __name__ == "__main__":
         except ValueError:
             print("Max depth must be a non-negative integer.")
             max_depth = -1
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(write_site_map(domain, max_depth))
+    # uvloop's event loop is faster than asyncio's, but is not available on
+    # every platform.
+    run = uvloop.run if uvloop else asyncio.run
+    run(write_site_map(domain, max_depth))
@@ -1,12 +1,31 @@
+import asyncio
+from contextlib import asynccontextmanager, redirect_stdout
+import io
+import json
+import os
+import tempfile
+import time
+from typing import Dict, List, Union
 import unittest
+from unittest import mock
+
+from aiohttp import client_exceptions
 
 from generate_site_map import (
+    FetchLimiter,
+    build_site_map,
+    decode_body,
+    fetch_html,
+    iter_site_maps,
+    write_site_map,
     get_all_links_from_html,
     strip_http_www,
+    canonicalize_url,
     get_domain_links,
     is_image_link,
     get_image_links,
     get_non_image_links,
+    partition_links,
 )
 
 
@@ -37,8 +56,82 @@ TEST_LINKS = [
     "http://example2.com/img2.ico",
 ]
 
+TEST_DOMAIN = "http://www.example.com/"
+
+
+def html_linking(*urls: str) -> str:
+    """Get an HTML string with a link to each of `urls`."""
+    return "".join(f'<a href="{url}">link</a>' for url in urls)
+
+
+class StubResponse:
+    """A stand-in for `aiohttp.ClientResponse`."""
+
+    def __init__(self, body: str, status: int, content_type: str) -> None:
+        self.status = status
+        self.headers = {"Content-Type": content_type}
+        self.charset = "utf-8"
+        self.content = asyncio.StreamReader()
+        self.content.feed_data(body.encode())
+        self.content.feed_eof()
+
+    def raise_for_status(self) -> None:
+        if self.status >= 400:
+            raise client_exceptions.ClientResponseError(
+                None, (), status=self.status
+            )
+
+
+class StubSession:
+    """
+    A stand-in for `aiohttp.ClientSession` that serves `pages`.  A page is
+    either an HTML string, a status code, or an exception to raise.  A list
+    of these is served one item per request, the last one repeating.  URLs
+    not in `pages` are served an empty HTML page.
+    """
+
+    def __init__(
+        self,
+        pages: Dict[str, Union[str, int, Exception, List]],
+        content_type: str = "text/html",
+    ) -> None:
+        self.pages = pages
+        self.content_type = content_type
+        self.requests: List[str] = []
+
+    @asynccontextmanager
+    async def get(self, url: str):
+        page = self.pages.get(url, "")
+        if isinstance(page, list):
+            page = page[min(self.requests.count(url), len(page) - 1)]
+        self.requests.append(url)
+        if isinstance(page, Exception):
+            raise page
+        if isinstance(page, int):
+            yield StubResponse("", page, self.content_type)
+        else:
+            yield StubResponse(page, 200, self.content_type)
+
 
 class TestGenerateSiteMap(unittest.TestCase):
+    def test_decode_body(self):
+        """Verify `decode_body()` decodes a response body with its charset."""
+        # verify the given charset is used
+        self.assertEqual(
+            decode_body("café".encode("latin-1"), "latin-1"),
+            "café",
+        )
+
+        # verify UTF-8 is used without a charset or with an unknown charset
+        self.assertEqual(decode_body("café".encode(), None), "café")
+        self.assertEqual(decode_body("café".encode(), "unknown"), "café")
+
+        # verify a truncated character is replaced
+        self.assertEqual(
+            decode_body("café".encode()[:-1], None),
+            "caf\ufffd",
+        )
+
     def test_get_all_links_from_html(self):
         """
         Verify `get_all_links_from_html()` returns unique links from an HTML
@@ -49,6 +142,24 @@ class TestGenerateSiteMap(unittest.TestCase):
             {"https://www.mozilla.org/media/img/favicon/apple-touch-icon-180x180.8772ec154918.png", "https://www.mozilla.org/media/img/favicon/favicon-196x196.c80e6abe0767.png", "https://www.mozilla.org/media/img/favicon.d4f1f46b91f4.ico", "https://www.mozilla.org/en-US/", "https://www.mozilla.org/an/", "https://www.mozilla.org/ar/", "https://www.mozilla.org/az/", "https://www.mozilla.org/be/", "https://www.mozilla.org/bg/", "https://www.mozilla.org/bs/", "https://www.mozilla.org/ca/"}  # noqa
         )
 
+        # verify links with a port are extracted
+        self.assertEqual(
+            get_all_links_from_html(
+                '<a href="https://example.com:8080/page.html">'
+            ),
+            ["https://example.com:8080/page.html"],
+        )
+        self.assertEqual(
+            get_all_links_from_html('<a href="http://example.com:8080">'),
+            ["http://example.com:8080"],
+        )
+
+        # verify links with an uppercase host are extracted
+        self.assertEqual(
+            get_all_links_from_html('<a href="https://EXAMPLE.COM/a.html">'),
+            ["https://EXAMPLE.COM/a.html"],
+        )
+
     def test_strip_http_www(self):
         """
         Verify `test_strip_http_www()` removes trailing "/"s and leading
@@ -72,6 +183,64 @@ class TestGenerateSiteMap(unittest.TestCase):
             "example.com",
         )
 
+        # verify with trailing "/"s
+        self.assertEqual(
+            strip_http_www("https://example.com//"),
+            "example.com",
+        )
+
+        # verify only the prefixes are removed, not their characters
+        self.assertEqual(
+            strip_http_www("https://photos.example.com"),
+            "photos.example.com",
+        )
+        self.assertEqual(
+            strip_http_www("http://www.wwwexample.com"),
+            "wwwexample.com",
+        )
+
+    def test_canonicalize_url(self):
+        """
+        Verify `canonicalize_url()` gives the same key to URLs of the same
+        page.
+        """
+        # verify scheme, "www.", host case, and trailing "/"s are ignored
+        self.assertEqual(
+            {
+                canonicalize_url(url) for url in [
+                    "https://example.com/a",
+                    "https://example.com/a/",
+                    "http://www.example.com/a",
+                    "HTTPS://WWW.EXAMPLE.COM/a//",
+                ]
+            },
+            {"example.com/a"},
+        )
+
+        # verify default ports and fragments are dropped
+        self.assertEqual(
+            canonicalize_url("https://example.com:443/a#top"),
+            "example.com/a",
+        )
+
+        # verify non-default ports are kept
+        self.assertEqual(
+            canonicalize_url("http://example.com:8080/"),
+            "example.com:8080",
+        )
+
+        # verify query parameters are sorted
+        self.assertEqual(
+            canonicalize_url("https://example.com/a?b=2&a=1"),
+            canonicalize_url("https://example.com/a/?a=1&b=2"),
+        )
+
+        # verify the path is case-sensitive
+        self.assertNotEqual(
+            canonicalize_url("https://example.com/a"),
+            canonicalize_url("https://example.com/A"),
+        )
+
     def test_get_domain_links(self):
         """Verify `get_domain_links()` correctly outputs only domain links."""
         # verify domain link with leading "https:"
@@ -140,6 +309,337 @@ class TestGenerateSiteMap(unittest.TestCase):
             },
         )
 
+    def test_partition_links(self):
+        """
+        Verify `partition_links()` returns the domain, image, and non-image
+        links.
+        """
+        domain_links, image_links, non_image_links = partition_links(
+            TEST_LINKS, "https://www.example.com/"
+        )
+        self.assertEqual(
+            set(domain_links),
+            {"https://example.com/", "http://example.com"},
+        )
+        self.assertEqual(set(image_links), set(get_image_links(TEST_LINKS)))
+        self.assertEqual(
+            set(non_image_links),
+            set(get_non_image_links(TEST_LINKS)),
+        )
+
+        # verify no domain links are collected without a domain URL
+        domain_links, image_links, non_image_links = partition_links(
+            TEST_LINKS, None
+        )
+        self.assertEqual(domain_links, [])
+        self.assertEqual(set(image_links), set(get_image_links(TEST_LINKS)))
+        self.assertEqual(
+            set(non_image_links),
+            set(get_non_image_links(TEST_LINKS)),
+        )
+
+
+@mock.patch("generate_site_map.MIN_FETCH_INTERVAL", 0.05)
+@mock.patch("generate_site_map.MAX_CONNECTIONS_PER_HOST", 4)
+class TestFetchLimiter(unittest.IsolatedAsyncioTestCase):
+    async def test_slot(self):
+        """
+        Verify `FetchLimiter.slot()` limits how many requests are sent to a
+        host at a time and how often they start, and limits each host
+        separately.
+        """
+        limiter = FetchLimiter()
+        start_times: Dict[str, List[float]] = {"a": [], "b": []}
+        in_flight = {"a": 0, "b": 0}
+        max_in_flight = {"a": 0, "b": 0}
+
+        async def request(host: str) -> None:
+            async with limiter.slot(host):
+                start_times[host].append(time.monotonic())
+                in_flight[host] += 1
+                max_in_flight[host] = max(max_in_flight[host], in_flight[host])
+                await asyncio.sleep(0.3)
+                in_flight[host] -= 1
+
+        began = time.monotonic()
+        await asyncio.gather(
+            *[request("a") for _ in range(8)],
+            request("b"),
+        )
+
+        # verify at most 4 requests are sent to the same host at a time
+        self.assertEqual(max_in_flight["a"], 4)
+
+        # verify requests to the same host start at least 0.05s apart
+        gaps = [
+            later - earlier
+            for earlier, later in zip(start_times["a"], start_times["a"][1:])
+        ]
+        self.assertGreaterEqual(min(gaps), 0.05 - 0.01)
+
+        # verify the fifth request waits for one of the first four to finish
+        self.assertGreaterEqual(start_times["a"][4] - began, 0.3 - 0.01)
+
+        # verify requests to another host are not delayed
+        self.assertLess(start_times["b"][0] - began, 0.05)
+
+
+@mock.patch("generate_site_map.MIN_FETCH_INTERVAL", 0)
+@mock.patch("generate_site_map.RETRY_BACKOFF", 0)
+class TestCrawl(unittest.IsolatedAsyncioTestCase):
+    async def test_fetch_html(self):
+        """Verify `fetch_html()` returns the HTML string of a page."""
+        session = StubSession({TEST_DOMAIN: "<html></html>"})
+        self.assertEqual(
+            await fetch_html(session, TEST_DOMAIN, FetchLimiter()),
+            "<html></html>",
+        )
+
+    async def test_fetch_html_non_html(self):
+        """Verify `fetch_html()` skips responses that are not HTML."""
+        session = StubSession(
+            {TEST_DOMAIN: "%PDF"},
+            content_type="application/pdf",
+        )
+        self.assertEqual(
+            await fetch_html(session, TEST_DOMAIN, FetchLimiter()),
+            "",
+        )
+
+    @mock.patch("generate_site_map.MAX_RESPONSE_BYTES", 4)
+    async def test_fetch_html_max_bytes(self):
+        """Verify `fetch_html()` reads at most `MAX_RESPONSE_BYTES` bytes."""
+        session = StubSession({TEST_DOMAIN: "<html></html>"})
+        self.assertEqual(
+            await fetch_html(session, TEST_DOMAIN, FetchLimiter()),
+            "<htm",
+        )
+
+    async def test_fetch_html_retry(self):
+        """Verify `fetch_html()` retries server and connection errors."""
+        session = StubSession({
+            TEST_DOMAIN: [
+                503,
+                client_exceptions.ClientConnectionError(),
+                "<html></html>",
+            ],
+        })
+        self.assertEqual(
+            await fetch_html(session, TEST_DOMAIN, FetchLimiter()),
+            "<html></html>",
+        )
+        self.assertEqual(len(session.requests), 3)
+
+    async def test_fetch_html_give_up(self):
+        """
+        Verify `fetch_html()` raises the last error once every attempt has
+        failed.
+        """
+        session = StubSession({TEST_DOMAIN: 500})
+        with self.assertRaises(client_exceptions.ClientResponseError):
+            await fetch_html(session, TEST_DOMAIN, FetchLimiter())
+        self.assertEqual(len(session.requests), 3)
+
+    async def test_fetch_html_no_retry_on_client_error(self):
+        """Verify `fetch_html()` does not retry 4xx responses."""
+        session = StubSession({TEST_DOMAIN: 404})
+        self.assertEqual(
+            await fetch_html(session, TEST_DOMAIN, FetchLimiter()),
+            "",
+        )
+        self.assertEqual(len(session.requests), 1)
+
+    async def test_iter_site_maps(self):
+        """Verify `iter_site_maps()` yields a site map for each page."""
+        session = StubSession({
+            TEST_DOMAIN: html_linking(
+                "http://www.example.com/a",
+                "http://www.example.com/img.png",
+                "http://other.org/",
+            ),
+        })
+        site_maps = [
+            site_map async for site_map in iter_site_maps(TEST_DOMAIN, session)
+        ]
+        self.assertEqual(len(site_maps), 2)
+        self.assertEqual(site_maps[0]["page_url"], TEST_DOMAIN)
+        self.assertEqual(
+            set(site_maps[0]["links"]),
+            {"http://www.example.com/a", "http://other.org/"},
+        )
+        self.assertEqual(
+            site_maps[0]["images"],
+            ["http://www.example.com/img.png"],
+        )
+        self.assertEqual(site_maps[1]["page_url"], "http://www.example.com/a")
+        self.assertEqual(
+            sorted(session.requests),
+            [TEST_DOMAIN, "http://www.example.com/a"],
+        )
+
+    async def test_iter_site_maps_max_depth(self):
+        """
+        Verify `iter_site_maps()` does not fetch pages deeper than
+        `max_depth`.
+        """
+        session = StubSession({
+            TEST_DOMAIN: html_linking("http://www.example.com/a"),
+            "http://www.example.com/a": html_linking(
+                "http://www.example.com/a/b"
+            ),
+        })
+        site_maps = await build_site_map(TEST_DOMAIN, session, 2)
+        self.assertEqual(
+            [site_map["page_url"] for site_map in site_maps],
+            [TEST_DOMAIN, "http://www.example.com/a"],
+        )
+        self.assertNotIn("http://www.example.com/a/b", session.requests)
+
+        # verify a depth of 0 fetches nothing
+        self.assertEqual(await build_site_map(TEST_DOMAIN, session, 0), [])
+
+    async def test_iter_site_maps_duplicates(self):
+        """
+        Verify `iter_site_maps()` fetches each page once, however its URL is
+        written.
+        """
+        session = StubSession({
+            TEST_DOMAIN: html_linking(
+                "http://www.example.com/a",
+                "https://example.com/a/",
+                "http://WWW.EXAMPLE.COM/a#top",
+                "https://example.com",
+            ),
+        })
+        site_maps = await build_site_map(TEST_DOMAIN, session)
+        self.assertEqual(len(site_maps), 2)
+        self.assertEqual(len(session.requests), 2)
+
+    async def test_iter_site_maps_unprocessable_url(self):
+        """
+        Verify `iter_site_maps()` reports pages that cannot be fetched and
+        crawls the rest.
+        """
+        session = StubSession({
+            TEST_DOMAIN: html_linking(
+                "http://www.example.com/a",
+                "http://www.example.com/b",
+            ),
+            "http://www.example.com/a": (
+                client_exceptions.ClientConnectionError()
+            ),
+        })
+        output = io.StringIO()
+        with redirect_stdout(output):
+            site_maps = await build_site_map(TEST_DOMAIN, session)
+        self.assertEqual(
+            {site_map["page_url"] for site_map in site_maps},
+            {TEST_DOMAIN, "http://www.example.com/b"},
+        )
+        self.assertIn("http://www.example.com/a", output.getvalue())
+
+    async def test_iter_site_maps_invalid_url(self):
+        """
+        Verify `iter_site_maps()` reports and skips links that are not valid
+        URLs.
+        """
+        session = StubSession({
+            TEST_DOMAIN: html_linking(
+                "http://www.example.com:99x.com/",
+                "http://www.example.com]x.com/",
+                "http://www.example.com/a",
+            ),
+        })
+        output = io.StringIO()
+        with redirect_stdout(output):
+            site_maps = await build_site_map(TEST_DOMAIN, session)
+        self.assertEqual(
+            [site_map["page_url"] for site_map in site_maps],
+            [TEST_DOMAIN, "http://www.example.com/a"],
+        )
+        self.assertIn("http://www.example.com:99x.com/", output.getvalue())
+        self.assertIn("http://www.example.com]x.com/", output.getvalue())
+
+        # verify an invalid starting URL is reported as well
+        output = io.StringIO()
+        with redirect_stdout(output):
+            site_maps = await build_site_map(
+                "http://www.example.com]x.com/", session, processed_sites=set()
+            )
+        self.assertEqual(site_maps, [])
+        self.assertIn("http://www.example.com]x.com/", output.getvalue())
+
+    async def test_iter_site_maps_error(self):
+        """
+        Verify an unexpected error while crawling is raised by
+        `iter_site_maps()` and stops every worker.
+        """
+        session = StubSession({
+            TEST_DOMAIN: html_linking("http://www.example.com/a"),
+            "http://www.example.com/a": RuntimeError("unexpected"),
+        })
+        with self.assertRaisesRegex(RuntimeError, "unexpected"):
+            await build_site_map(TEST_DOMAIN, session)
+        self.assertEqual(asyncio.all_tasks(), {asyncio.current_task()})
+
+    async def test_iter_site_maps_shutdown(self):
+        """Verify every worker is stopped once the crawl is finished."""
+        session = StubSession({
+            TEST_DOMAIN: html_linking("http://www.example.com/a"),
+        })
+        await build_site_map(TEST_DOMAIN, session)
+        self.assertEqual(asyncio.all_tasks(), {asyncio.current_task()})
+
+        # verify workers are stopped when iteration is abandoned early
+        site_maps = iter_site_maps(TEST_DOMAIN, session)
+        await site_maps.__anext__()
+        await site_maps.aclose()
+        self.assertEqual(asyncio.all_tasks(), {asyncio.current_task()})
+
+    async def test_write_site_map(self):
+        """
+        Verify `write_site_map()` writes the site maps into a JSON file, and
+        leaves an earlier file untouched if the crawl fails.
+        """
+        site_maps = [
+            {"page_url": TEST_DOMAIN, "links": [], "images": []},
+            {
+                "page_url": "http://www.example.com/a",
+                "links": ["http://other.org/"],
+                "images": [],
+            },
+        ]
+
+        async def crawl(*args):
+            for site_map in site_maps:
+                yield site_map
+
+        async def failing_crawl(*args):
+            yield site_maps[0]
+            raise RuntimeError("unexpected")
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "site_map.json")
+            temp_path = path + ".tmp"
+            with mock.patch.multiple(
+                "generate_site_map",
+                SITE_MAP_PATH=path,
+                SITE_MAP_TEMP_PATH=temp_path,
+            ):
+                with mock.patch("generate_site_map.iter_site_maps", crawl):
+                    await write_site_map(TEST_DOMAIN, 2)
+                with open(path) as f:
+                    self.assertEqual(json.load(f), site_maps)
+
+                with mock.patch(
+                    "generate_site_map.iter_site_maps", failing_crawl
+                ):
+                    with self.assertRaises(RuntimeError):
+                        await write_site_map(TEST_DOMAIN, 2)
+                with open(path) as f:
+                    self.assertEqual(json.load(f), site_maps)
+                self.assertFalse(os.path.exists(temp_path))
+
 
 if __name__ == "__main__":
     unittest.main()